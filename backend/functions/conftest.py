@@ -0,0 +1,8 @@
+"""
+Shared pytest setup - main.py builds Google Cloud clients, so tests run on anonymous credentials
+"""
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+
+# Patched before main is imported: no Application Default Credentials needed, no real API reachable
+google.auth.default = lambda *args, **kwargs: (AnonymousCredentials(), "analyst-iq")
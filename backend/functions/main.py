@@ -1,21 +1,268 @@
 import os
 import json
+import logging
+import orjson
 import base64
+import functools
+import hashlib
+import io
+import re
+import string
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from flask import Request
-from google.cloud import documentai
+from pypdf import PdfReader, PdfWriter
+from google.api_core import retry
+from google.api_core.exceptions import NotFound, ResourceExhausted, ServiceUnavailable
+from google.cloud import documentai, storage
+from google.cloud.documentai_v1.services.document_processor_service.transports import DocumentProcessorServiceGrpcTransport
+from google.protobuf import field_mask_pb2
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 import vertexai
-from vertexai.generative_models import GenerativeModel
+from vertexai.generative_models import GenerationConfig, GenerativeModel, Part
 import functions_framework
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+# Cloud Functions forwards stderr to Cloud Logging; basicConfig is a no-op if the runtime already set a handler
+logging.basicConfig(format="%(levelname)s %(message)s")
+logger = logging.getLogger("analyst_iq")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
 # Your actual project configuration
 PROJECT_ID = "analyst-iq"
 LOCATION = "us-central1"
 PROCESSOR_ID = "bd0934fc7b8dcd10"
 PROCESSOR_LOCATION = "us"
+DOCAI_ENDPOINT = f"{PROCESSOR_LOCATION}-documentai.googleapis.com:443"
+
+# One long-lived HTTP/2 channel is shared by all extraction threads; keepalive stops
+# idle warm instances from paying a fresh TLS handshake on the next request
+DOCAI_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+
+# Back off on quota (429) and transient unavailability (503) instead of failing the file
+DOCAI_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(ResourceExhausted, ServiceUnavailable),
+    initial=1.0,
+    maximum=10.0,
+    multiplier=2.0,
+    timeout=120.0
+)
+
+# Only the Document fields extract_with_document_ai reads - skips page images, tokens, layout blocks
+DOCAI_FIELD_MASK = field_mask_pb2.FieldMask(paths=[
+    "text",
+    "entities",
+    "pages.page_number",
+    "pages.tables",
+    "pages.form_fields",
+])
+
+# Multi-file uploads: Document AI calls are I/O-bound, so extract files concurrently
+MAX_EXTRACTION_WORKERS = 8
+# Instance-wide cap on in-flight process_document calls (shared by concurrent requests)
+MAX_DOCAI_CONCURRENCY = 8
+
+# Large uploads are streamed to GCS and handed to Document AI by URI
+INPUT_BUCKET_NAME = "analyst-iq-docai-input"
+STREAM_THRESHOLD = 5 * 1024 * 1024
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024  # Must be a multiple of 256 KB
+STREAM_UPLOAD_TIMEOUT = 300  # Seconds per chunk request
+PDF_PROBE_CHUNK_SIZE = 256 * 1024  # Ranged-read size when pypdf probes a PDF already in GCS
+
+# Upload limits - checked before any upload bytes are read into memory
+MAX_FILE_SIZE = 50 * 1024 * 1024
+MAX_FILE_SIZE_MB = MAX_FILE_SIZE // (1024 * 1024)
+MAX_REQUEST_SIZE = 4 * MAX_FILE_SIZE  # Several files per request plus multipart/base64 overhead
+MAX_JSON_BODY_SIZE = MAX_FILE_SIZE * 4 // 3 + 64 * 1024  # One base64-encoded file plus the JSON wrapper
+
+# Cheap filename pre-filter (O(1) set lookup) before the upload is touched
+ALLOWED_EXTENSIONS = frozenset({'pdf', 'png', 'jpg', 'jpeg', 'tif', 'tiff', 'gif'})
+ALLOWED_EXTENSIONS_STR = ', '.join(sorted(ALLOWED_EXTENSIONS))
+
+# Magic-byte signatures of the file types Document AI accepts - the client-supplied
+# content type is not trusted
+SNIFF_BYTES = 16
+FILE_SIGNATURES = (
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+# Signatures grouped by leading byte - one dict lookup rejects almost every unsupported file
+FILE_SIGNATURES_BY_LEAD = {
+    lead: tuple(entry for entry in FILE_SIGNATURES if entry[0][:1] == lead)
+    for lead in {signature[:1] for signature, _ in FILE_SIGNATURES}
+}
+
+# Bodies posted as the file itself (no base64/JSON or multipart wrapping) - name comes from X-File-Name
+RAW_UPLOAD_MIME_TYPES = frozenset({"application/octet-stream"} | {mime for _, mime in FILE_SIGNATURES})
+
+# Online Document AI page cap with imageless_mode=True on the ProcessRequest (15 without it) -
+# shard size and the page-count probe both rely on every request opting in
+MAX_ONLINE_PAGES = 30
+# Longer PDFs are split into MAX_ONLINE_PAGES shards processed in parallel, up to this many shards
+MAX_PDF_SHARDS = 10
+# Beyond that, a PDF whose embedded text layer is this dense is read locally with pypdf (no OCR needed)
+TEXT_LAYER_MIN_CHARS_PER_PAGE = 200
+
+# Warm-instance cache of extractions/analyses keyed by SHA-256 of the uploaded bytes
+CACHE_TTL_SECONDS = 60 * 60
+CACHE_MAX_ENTRIES = 32
+
+# ✅ CORRECT MODEL PRIORITY FOR US-CENTRAL1 - probed in order, first working model wins
+GEMINI_MODELS = (
+    "gemini-1.5-flash-001",    # ✅ Specific version that works
+    "gemini-1.0-pro-001",      # ✅ Stable version
+    "text-bison@001",          # ✅ Vertex AI Text model fallback
+)
+
+# Re-probe the Gemini model list this often so a retired model is eventually replaced
+MODEL_PROBE_TTL_SECONDS = 60 * 60
+
+# Bump whenever the prompt, schema or text sampling changes - part of the analysis cache key
+PROMPT_VERSION = "3"
+
+# Gemini analysis prompt - static instructions first, per-request $placeholders only at the end
+ANALYSIS_PROMPT_TEMPLATE = string.Template("""
+        Analyze this business document and provide analysis as JSON:
+        {
+            "document_type": "financial report/contract/memo/etc",
+            "summary": "Brief executive summary in 2 sentences",
+            "key_insights": ["insight 1", "insight 2", "insight 3"],
+            "financial_metrics": {"revenue": "amount", "profit": "amount"},
+            "risk_factors": ["risk 1", "risk 2"],
+            "recommendations": ["action 1", "action 2"],
+            "confidence_level": "High"
+        }
+
+        Return only valid JSON without markdown.
+
+        Business document:
 
-# Initialize Vertex AI
-vertexai.init(project=PROJECT_ID, location=LOCATION)
+        Pages: $page_count
+        Entities found: $entity_count
+        Tables found: $table_count
+""")
+
+class FileTooLargeError(ValueError):
+    """Upload exceeds MAX_FILE_SIZE / MAX_REQUEST_SIZE - reported as HTTP 413"""
+
+class InvalidUploadError(ValueError):
+    """Missing, unsupported or unrecognised upload - reported as HTTP 400"""
+
+class BoundedStream:
+    """
+    Request stream wrapper that stops a body without Content-Length at limit bytes.
+    Raises RequestEntityTooLarge - Werkzeug's form parser silently swallows ValueErrors.
+    """
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.remaining = limit
+    
+    def read(self, size=-1):
+        return self._checked(self.stream.read(self._cap(size)))
+    
+    def readline(self, size=-1):
+        return self._checked(self.stream.readline(self._cap(size)))
+    
+    def _cap(self, size):
+        # Ask for one byte past the limit so an overrun is detected, never silently truncated
+        return self.remaining + 1 if size is None or size < 0 else min(size, self.remaining + 1)
+    
+    def _checked(self, data):
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            raise RequestEntityTooLarge()
+        return data
+
+# Per-document text sample sent to Gemini - cut back to a sentence/word boundary
+PROMPT_TEXT_CHARS = 1200
+
+# Linear scan for the first complete JSON object in prose/fenced model output
+JSON_DECODER = json.JSONDecoder()
+# Trailing commas before } or ] - the most common syntax slip in non-JSON-mode output
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+# Structured output for models that support JSON mode (Gemini 1.5+) - mirrors the prompt schema
+JSON_MODE_MODEL_PREFIXES = ("gemini-1.5",)
+ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "document_type": {"type": "string"},
+        "summary": {"type": "string"},
+        "key_insights": {"type": "array", "items": {"type": "string"}},
+        "financial_metrics": {
+            "type": "object",
+            "properties": {"revenue": {"type": "string"}, "profit": {"type": "string"}}
+        },
+        "risk_factors": {"type": "array", "items": {"type": "string"}},
+        "recommendations": {"type": "array", "items": {"type": "string"}},
+        "confidence_level": {"type": "string", "enum": ["High", "Medium", "Low"]}
+    },
+    "required": ["document_type", "summary", "key_insights", "risk_factors", "recommendations", "confidence_level"]
+}
+
+# Headers for every JSON response (success, error, detailed health) - built once, never mutated
+RESPONSE_HEADERS = {
+    'Access-Control-Allow-Origin': 'http://localhost:8080',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+    'Content-Type': 'application/json'
+}
+
+# Precomputed CORS preflight response - Max-Age lets browsers skip repeat preflights for a day
+CORS_PREFLIGHT_RESPONSE = (
+    '',
+    204,
+    {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-File-Name',
+        'Access-Control-Max-Age': '86400'
+    }
+)
+
+# Precomputed ?health=true response - readiness probes skip all per-request work
+HEALTH_RESPONSE = (
+    b'{"status":"ok"}',
+    200,
+    {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+)
+
+PROCESSOR_NAME = documentai.DocumentProcessorServiceClient.processor_path(PROJECT_ID, PROCESSOR_LOCATION, PROCESSOR_ID)
+docai_semaphore = threading.BoundedSemaphore(MAX_DOCAI_CONCURRENCY)
+
+# Single Document AI / Storage clients shared by every thread - built by get_docai_client() / get_storage_client()
+docai_client = None
+docai_client_lock = threading.Lock()
+storage_client = None
+storage_client_lock = threading.Lock()
+
+# (model_name, GenerativeModel, probed_at) picked by select_gemini_model() - probed once per TTL
+gemini_model = None
+gemini_model_lock = threading.Lock()
+
+# Results cache - survives between invocations on the same instance
+extraction_cache = OrderedDict()
+analysis_cache = OrderedDict()
+cache_lock = threading.Lock()
+
+# Off-request-thread work (Gemini model probing overlaps Document AI extraction, GCS cleanup overlaps Gemini).
+# Cleanup futures are always joined before the response - CPU is throttled once it is sent
+background_executor = ThreadPoolExecutor(max_workers=4)
 
 @functions_framework.http
 def analyze_document(request: Request):
@@ -23,54 +270,214 @@ def analyze_document(request: Request):
     Main AI function: Extract data with Document AI + Analyze with Gemini
     VERSION 3.0 - COMPLETE FIXED VERSION
     """
+    # Preflight and health probes return precomputed responses before any per-request work
+    if request.method == 'OPTIONS':
+        return CORS_PREFLIGHT_RESPONSE
+    if request.args.get('health') == 'true':
+        return HEALTH_RESPONSE
+    
+    started_at = time.monotonic()
+    uploaded_blobs = []  # Streamed GCS inputs - always deleted in the finally block
+    cleanup_future = None  # Delete overlapping Gemini - awaited before the response is returned
     try:
-        # ✅ LOG: Confirm new code is running
-        print("🚀 VERSION 3.0 - COMPLETE FIXED VERSION RUNNING")
-        print(f"📅 Request timestamp: {datetime.now()}")
-        print(f"🔧 Using processor: {PROCESSOR_ID}")
+        # ✅ LOG: Confirm new code is running (skipped entirely below DEBUG - no clock read)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🚀 VERSION 3.0 - COMPLETE FIXED VERSION RUNNING")
+            logger.debug("📅 Request timestamp: %s", datetime.now())
+            logger.debug("🔧 Using processor: %s", PROCESSOR_ID)
         
-        # Handle CORS
-        if request.method == 'OPTIONS':
-            print("✅ CORS preflight request handled")
-            headers = {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization'
-            }
-            return ('', 204, headers)
+        # ✅ Reject oversized bodies from the header, before Flask parses/buffers them
+        max_body_size = MAX_JSON_BODY_SIZE if request.content_type == 'application/json' else MAX_REQUEST_SIZE
+        if request.content_length and request.content_length > max_body_size:
+            raise FileTooLargeError(f"Request body exceeds {max_body_size // (1024 * 1024)}MB")
         
         # Get uploaded file data
-        if request.content_type == 'application/json':
-            file_data = request.get_json()
-            pdf_content = file_data.get('pdf_content')
-            print(f"📄 Received JSON with PDF content length: {len(pdf_content) if pdf_content else 0}")
-        else:
-            file = request.files.get('file')
-            if file:
-                pdf_content = base64.b64encode(file.read()).decode('utf-8')
-                print(f"📄 Received file upload, encoded length: {len(pdf_content)}")
+        uploads = []
+        results = []
+        if request.mimetype in RAW_UPLOAD_MIME_TYPES and (request.content_length or 0) > STREAM_THRESHOLD:
+            # ✅ LARGE RAW BODY: pipe the request stream straight to GCS - never buffered in memory
+            file_name = request.headers.get('X-File-Name', 'document.pdf')
+            if not has_allowed_extension(file_name):
+                raise InvalidUploadError(f"Unsupported file extension for {file_name} - allowed: {ALLOWED_EXTENSIONS_STR}")
+            if request.content_length > MAX_FILE_SIZE:
+                raise FileTooLargeError(f"{file_name} exceeds {MAX_FILE_SIZE_MB}MB")
+            head = request.stream.read(SNIFF_BYTES)
+            mime_type = sniff_mime_type(head)
+            if mime_type is None:
+                raise InvalidUploadError(f"Unsupported file type for {file_name} - expected a PDF or image")
+            blob = get_storage_client().bucket(INPUT_BUCKET_NAME).blob(upload_blob_name(file_name))
+            uploaded_blobs.append(blob)
+            file_size, digest = stream_body_to_gcs(request.stream, head, blob, mime_type)
+            gcs_uri = f"gs://{INPUT_BUCKET_NAME}/{blob.name}"
+            logger.info("📄 Received large raw upload %s (%d bytes), streamed to %s", file_name, file_size, gcs_uri)
+            cached_data = get_cached_extraction(digest, file_name)
+            results.append(cached_data)
+            page_count = None
+            if cached_data is None and mime_type == "application/pdf":
+                # ✅ BlobReader is seekable - pypdf fetches only the xref and page tree with ranged reads
+                with blob.open("rb", chunk_size=PDF_PROBE_CHUNK_SIZE) as reader:
+                    page_count = count_pdf_pages(reader)
+            if cached_data is not None:
+                uploads.append((None, file_name, file_size, digest, mime_type, None))
+            elif page_count and page_count > MAX_ONLINE_PAGES * MAX_PDF_SHARDS:
+                # ✅ Too long to shard - read the text layer back from GCS, never into memory
+                with blob.open("rb", chunk_size=STREAM_CHUNK_SIZE) as reader:
+                    results[-1] = extract_unshardable_pdf(reader, file_name, file_size, digest, page_count)
+                uploads.append((None, file_name, file_size, digest, mime_type, page_count))
+            elif page_count and page_count > MAX_ONLINE_PAGES:
+                # ✅ Over the online page limit - download the bytes for local splitting into shards
+                uploads.append((blob.download_as_bytes(), file_name, file_size, digest, mime_type, page_count))
             else:
-                raise ValueError("No file provided")
+                uploads.append((gcs_uri, file_name, file_size, digest, mime_type, page_count))
+        elif request.content_type == 'application/json' or request.mimetype in RAW_UPLOAD_MIME_TYPES:
+            if request.content_type == 'application/json':
+                # ✅ Bounded read straight off the stream - nothing is cached on the request
+                try:
+                    file_data = orjson.loads(read_request_body(request, MAX_JSON_BODY_SIZE))
+                except orjson.JSONDecodeError as e:
+                    raise InvalidUploadError(f"Malformed JSON body: {e}")
+                if not isinstance(file_data, dict):
+                    raise InvalidUploadError("JSON body must be an object with pdf_content")
+                pdf_content = file_data.get('pdf_content')
+                if not pdf_content:
+                    raise InvalidUploadError("No PDF content received")
+                if not isinstance(pdf_content, str):
+                    raise InvalidUploadError("pdf_content must be a base64 string")
+                logger.info("📄 Received JSON with PDF content length: %d", len(pdf_content))
+                file_name = file_data.get('file_name', 'document.pdf')
+                if not isinstance(file_name, str):
+                    raise InvalidUploadError("file_name must be a string")
+                if not has_allowed_extension(file_name):
+                    raise InvalidUploadError(f"Unsupported file extension for {file_name} - allowed: {ALLOWED_EXTENSIONS_STR}")
+                if len(pdf_content) * 3 // 4 > MAX_FILE_SIZE:
+                    raise FileTooLargeError(f"{file_name} exceeds {MAX_FILE_SIZE_MB}MB")
+                try:
+                    file_bytes = base64.b64decode(pdf_content, validate=True)
+                except ValueError as e:  # binascii.Error, or non-ASCII characters
+                    raise InvalidUploadError(f"pdf_content is not valid base64: {e}")
+                del file_data, pdf_content  # Only the decoded bytes stay resident from here on
+            else:
+                # ✅ RAW BODY: the request body is the file - no base64 string or decode at all
+                file_name = request.headers.get('X-File-Name', 'document.pdf')
+                if not has_allowed_extension(file_name):
+                    raise InvalidUploadError(f"Unsupported file extension for {file_name} - allowed: {ALLOWED_EXTENSIONS_STR}")
+                if request.content_length and request.content_length > MAX_FILE_SIZE:
+                    raise FileTooLargeError(f"{file_name} exceeds {MAX_FILE_SIZE_MB}MB")
+                file_bytes = read_request_body(request, MAX_FILE_SIZE)
+                logger.info("📄 Received raw upload %s, size: %d bytes", file_name, len(file_bytes))
+                if not file_bytes:
+                    raise InvalidUploadError("No PDF content received")
+            
+            if len(file_bytes) > MAX_FILE_SIZE:
+                raise FileTooLargeError(f"{file_name} exceeds {MAX_FILE_SIZE_MB}MB")
+            mime_type = sniff_mime_type(file_bytes)
+            if mime_type is None:
+                raise InvalidUploadError(f"Unsupported file type for {file_name} - expected a PDF or image")
+            digest = hashlib.sha256(file_bytes).hexdigest()
+            results.append(get_cached_extraction(digest, file_name))
+            uploads.append((file_bytes, file_name, len(file_bytes), digest, mime_type, None))
+        else:
+            # ✅ Chunked multipart bodies have no Content-Length to check - bound the parser's reads instead
+            if request.content_length is None:
+                request.stream = BoundedStream(request.stream, MAX_REQUEST_SIZE)
+            try:
+                # ✅ FileStorage is not thread-safe - read every upload before fanning out
+                files = request.files.getlist('file') + request.files.getlist('documents')
+            except RequestEntityTooLarge:
+                raise FileTooLargeError(f"Request body exceeds {MAX_REQUEST_SIZE // (1024 * 1024)}MB")
+            if not files:
+                raise InvalidUploadError("No file provided")
+            for file in files:
+                if not has_allowed_extension(file.filename):
+                    raise InvalidUploadError(f"Unsupported file extension for {file.filename} - allowed: {ALLOWED_EXTENSIONS_STR}")
+                
+                file_size = get_upload_size(file)
+                if not file_size:
+                    raise InvalidUploadError(f"No PDF content received for {file.filename}")
+                if file_size > MAX_FILE_SIZE:
+                    raise FileTooLargeError(f"{file.filename} exceeds {MAX_FILE_SIZE_MB}MB")
+                
+                # ✅ Reject unsupported files from their first bytes, before hashing/uploading
+                mime_type = sniff_mime_type(file.stream.read(SNIFF_BYTES))
+                file.stream.seek(0)
+                if mime_type is None:
+                    raise InvalidUploadError(f"Unsupported file type for {file.filename} - expected a PDF or image")
+                
+                # ✅ Small files: one read serves both the hash and the Document AI payload
+                file_bytes = file.stream.read(file_size) if file_size <= STREAM_THRESHOLD else None
+                digest = hashlib.sha256(file_bytes).hexdigest() if file_bytes is not None else get_upload_digest(file)
+                cached_data = get_cached_extraction(digest, file.filename)
+                page_count = None
+                if cached_data is None and file_size > STREAM_THRESHOLD and mime_type == "application/pdf":
+                    page_count = count_pdf_pages(file.stream)
+                    file.stream.seek(0)
+                results.append(cached_data)
+                if cached_data is not None:
+                    # ✅ DUPLICATE UPLOAD: reuse the cached extraction, skip GCS + Document AI
+                    uploads.append((None, file.filename, file_size, digest, mime_type, None))
+                elif page_count and page_count > MAX_ONLINE_PAGES * MAX_PDF_SHARDS:
+                    # ✅ Too long to shard - read the text layer from the spooled stream, never into memory
+                    logger.info("📄 Received file upload %s (%d pages), too long for Document AI", file.filename, page_count)
+                    results[-1] = extract_unshardable_pdf(file.stream, file.filename, file_size, digest, page_count)
+                    uploads.append((None, file.filename, file_size, digest, mime_type, page_count))
+                elif page_count and page_count > MAX_ONLINE_PAGES:
+                    # ✅ Over the online page limit - keep the bytes for local splitting into shards
+                    logger.info("📄 Received file upload %s (%d pages), kept in memory for local splitting", file.filename, page_count)
+                    uploads.append((file.stream.read(file_size), file.filename, file_size, digest, mime_type, page_count))
+                elif file_size > STREAM_THRESHOLD:
+                    # ✅ LARGE FILE: stream to GCS instead of reading it into memory
+                    blob = stream_upload_to_gcs(file, file_size, mime_type)
+                    uploaded_blobs.append(blob)
+                    gcs_uri = f"gs://{INPUT_BUCKET_NAME}/{blob.name}"
+                    logger.info("📄 Received large file upload %s, streamed to %s", file.filename, gcs_uri)
+                    uploads.append((gcs_uri, file.filename, file_size, digest, mime_type, page_count))
+                else:
+                    # ✅ Raw bytes go straight to Document AI - no base64 round trip
+                    logger.info("📄 Received file upload %s, size: %d bytes", file.filename, len(file_bytes))
+                    uploads.append((file_bytes, file.filename, file_size, digest, mime_type, None))
         
-        if not pdf_content:
-            raise ValueError("No PDF content received")
+        # ✅ Probe Gemini models while Document AI works on the files (unless the analysis is cached)
+        analysis_key = hashlib.sha256(
+            (PROMPT_VERSION + "".join(sorted(upload[3] for upload in uploads))).encode('utf-8')
+        ).hexdigest()
+        ai_insights = get_cached(analysis_cache, analysis_key)
+        model_future = background_executor.submit(select_gemini_model) if ai_insights is None else None
         
-        # Estimate page count from file size
-        pdf_bytes = base64.b64decode(pdf_content)
-        estimated_pages = len(pdf_bytes) // 50000  # Rough estimation
-        print(f"📊 File size: {len(pdf_bytes)} bytes, estimated pages: ~{estimated_pages}")
+        # Step 1: Extract data with Document AI (one worker per uncached file)
+        pending = [idx for idx, data in enumerate(results) if data is None]
+        logger.debug("🤖 STARTING DOCUMENT AI EXTRACTION FOR %d OF %d FILE(S) (VERSION 3.0)...", len(pending), len(uploads))
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(MAX_EXTRACTION_WORKERS, len(pending))) as executor:
+                futures = {
+                    executor.submit(process_uploaded_file, *uploads[idx]): idx
+                    for idx in pending
+                }
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+        
+        # ✅ Document AI is done with the streamed inputs - delete them while Gemini runs
+        if uploaded_blobs:
+            cleanup_future = background_executor.submit(delete_uploaded_blobs, uploaded_blobs)
+            uploaded_blobs = []
         
-        # Step 1: Extract data with Document AI
-        print("🤖 STARTING DOCUMENT AI EXTRACTION (VERSION 3.0)...")
-        extracted_data = extract_with_document_ai(pdf_content)
-        print(f"✅ Document AI completed. Pages processed: {extracted_data.get('page_count', 'unknown')}")
+        extracted_data = results[0] if len(results) == 1 else merge_extracted_data(results)
+        logger.debug("✅ Document AI completed. Pages processed: %s", extracted_data.get('page_count', 'unknown'))
         
-        # Step 2: Analyze with Gemini
-        print("🧠 STARTING GEMINI ANALYSIS (VERSION 3.0)...")
-        ai_insights = analyze_with_gemini(extracted_data)
-        print("✅ Gemini analysis completed")
+        # Step 2: Analyze with Gemini (skipped when the same file set was analyzed recently)
+        if ai_insights is not None:
+            logger.info("♻️ Reusing cached Gemini analysis %.12s", analysis_key)
+        else:
+            logger.debug("🧠 STARTING GEMINI ANALYSIS (VERSION 3.0)...")
+            ai_insights = analyze_with_gemini(extracted_data, model_future)
+            # ✅ Only cache analyses of clean extractions - checked per file, the merged payload drops "note"
+            extraction_ok = not any(data.get("error_in_extraction") or "note" in data for data in results)
+            if extraction_ok and ai_insights.get("ai_model_used") != "error" and "note" not in ai_insights:
+                put_cached(analysis_cache, analysis_key, ai_insights)
+            logger.debug("✅ Gemini analysis completed")
         
         # Step 3: Return combined results
+        # ✅ orjson serializes datetime natively (ISO 8601), no isoformat() round trip
+        processed_at = datetime.now()
         result = {
             "status": "success",
             "extracted_data": extracted_data,
@@ -81,71 +488,328 @@ def analyze_document(request: Request):
                 "gemini_analysis": True,
                 "confidence_score": 0.95,
                 "version": "3.0_complete_fixed",
-                "processed_at": datetime.now().isoformat(),
+                "processed_at": processed_at,
                 "region": LOCATION
             },
-            "timestamp": json.dumps({"processed_at": datetime.now().isoformat()})
+            "timestamp": orjson.dumps({"processed_at": processed_at}).decode()
         }
         
-        headers = {
-            'Access-Control-Allow-Origin': 'http://localhost:8080',
-            'Access-Control-Allow-Methods': 'POST, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-            'Content-Type': 'application/json'
-        }
-        
-        print("🎉 REQUEST COMPLETED SUCCESSFULLY WITH VERSION 3.0")
-        return (json.dumps(result), 200, headers)
+        # ✅ Serialize before logging - a failure here must only produce the 500 summary line
+        body = orjson.dumps(result)
+        log_request_summary(
+            started_at, 200,
+            files=len(uploads),
+            extracted=len(pending),
+            pages=extracted_data.get('page_count'),
+            model=ai_insights.get('ai_model_used')
+        )
+        return (body, 200, RESPONSE_HEADERS)
         
     except Exception as e:
-        print(f"❌ ERROR IN VERSION 3.0: {str(e)}")
-        print(f"❌ Error type: {type(e).__name__}")
+        logger.error("❌ ERROR IN VERSION 3.0: %s: %s", type(e).__name__, e)
         error_result = {
             "status": "error",
             "message": str(e),
             "error_type": type(e).__name__,
             "version": "3.0_complete_fixed"
         }
-        headers = {
-            'Access-Control-Allow-Origin': 'http://localhost:8080',
-            'Content-Type': 'application/json'
-        }
-        return (json.dumps(error_result), 500, headers)
+        if isinstance(e, FileTooLargeError):
+            status_code = 413
+        elif isinstance(e, InvalidUploadError):
+            status_code = 400
+        else:
+            status_code = 500
+        log_request_summary(started_at, status_code, error_type=type(e).__name__)
+        return (orjson.dumps(error_result), status_code, RESPONSE_HEADERS)
+    
+    finally:
+        # CPU is throttled once the response is sent, so cleanup must finish before we return
+        if cleanup_future is not None:
+            cleanup_future.result()
+        # Error paths: whatever was streamed before the failure is still deleted
+        if uploaded_blobs:
+            delete_uploaded_blobs(uploaded_blobs)
+
+def log_request_summary(started_at, status_code, **fields):
+    """
+    One machine-parseable JSON line per request (status, duration, counts) for log-based metrics
+    """
+    fields.update(event="analyze_document", status=status_code, dur_ms=round((time.monotonic() - started_at) * 1000))
+    logger.info("%s", orjson.dumps(fields).decode())
+
+# Clients are created on first use (not at import) so cold starts that only serve
+# preflight/health requests never build them - cached for the life of the instance
+def get_storage_client():
+    """
+    Cloud Storage client for the Document AI input bucket - built once under storage_client_lock
+    """
+    global storage_client
+    with storage_client_lock:
+        if storage_client is None:
+            storage_client = storage.Client(project=PROJECT_ID)
+        return storage_client
+
+def get_docai_client():
+    """
+    Document AI client on a keepalive gRPC channel reused by warm invocations.
+    Built under docai_client_lock - functools.cache would let concurrent first calls each open a channel.
+    """
+    global docai_client
+    with docai_client_lock:
+        if docai_client is None:
+            docai_client = documentai.DocumentProcessorServiceClient(
+                transport=DocumentProcessorServiceGrpcTransport(
+                    host=DOCAI_ENDPOINT,
+                    channel=DocumentProcessorServiceGrpcTransport.create_channel(DOCAI_ENDPOINT, options=DOCAI_CHANNEL_OPTIONS)
+                )
+            )
+        return docai_client
+
+@functools.cache
+def init_vertexai():
+    """
+    Initialize Vertex AI once, before the first GenerativeModel is built
+    """
+    vertexai.init(project=PROJECT_ID, location=LOCATION)
+
+def get_cached(cache, key):
+    """
+    Return a fresh cache entry (LRU order, TTL-checked) or None
+    """
+    with cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > CACHE_TTL_SECONDS:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return value
+
+def put_cached(cache, key, value):
+    """
+    Store a cache entry, evicting the least recently used ones past CACHE_MAX_ENTRIES
+    """
+    with cache_lock:
+        cache[key] = (time.monotonic(), value)
+        cache.move_to_end(key)
+        while len(cache) > CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def get_cached_extraction(digest, filename):
+    """
+    Cached Document AI result for an upload digest, relabelled with this upload's filename
+    """
+    cached_data = get_cached(extraction_cache, digest)
+    if cached_data is None:
+        return None
+    logger.info("♻️ Cache hit for %s (%.12s) - skipping Document AI", filename, digest)
+    return dict(cached_data, file_name=filename)
+
+def has_allowed_extension(filename):
+    """
+    True when the filename ends in one of ALLOWED_EXTENSIONS (a bare "pdf" with no dot doesn't count)
+    """
+    return os.path.splitext(filename or "")[1][1:].lower() in ALLOWED_EXTENSIONS
+
+def read_request_body(request, limit):
+    """
+    Read at most limit bytes of the body - chunked bodies without Content-Length can't overrun it
+    """
+    body = request.stream.read(limit + 1)
+    if len(body) > limit:
+        raise FileTooLargeError(f"Request body exceeds {limit // (1024 * 1024)}MB")
+    return body
+
+def sniff_mime_type(head):
+    """
+    MIME type from a file's leading magic bytes - None for unsupported files.
+    Works on the whole file too: startswith only looks at the first bytes, no slice needed.
+    """
+    for signature, mime_type in FILE_SIGNATURES_BY_LEAD.get(head[:1], ()):
+        if head.startswith(signature):
+            return mime_type
+    return None
+
+def get_upload_digest(file):
+    """
+    SHA-256 of an uploaded file, hashed chunk by chunk from the spooled stream
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.stream.read(STREAM_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+def get_upload_size(file):
+    """
+    Size of an uploaded file without reading it (Werkzeug spools parts to a seekable file)
+    """
+    file.stream.seek(0, os.SEEK_END)
+    file_size = file.stream.tell()
+    file.stream.seek(0)
+    return file_size
+
+def stream_upload_to_gcs(file, file_size, mime_type):
+    """
+    Pipe an upload to the Document AI input bucket in fixed-size chunks and return the blob
+    """
+    blob = get_storage_client().bucket(INPUT_BUCKET_NAME).blob(upload_blob_name(file.filename), chunk_size=STREAM_CHUNK_SIZE)
+    blob.upload_from_file(
+        file.stream,
+        size=file_size,
+        content_type=mime_type,
+        checksum="md5",
+        timeout=STREAM_UPLOAD_TIMEOUT,
+        if_generation_match=0  # Create-only - also lets the client retry a failed chunk
+    )
+    return blob
+
+def stream_body_to_gcs(stream, head, blob, mime_type):
+    """
+    Copy a raw request body to GCS chunk by chunk, hashing as it goes - returns (size, sha256 hexdigest)
+    """
+    digest = hashlib.sha256(head)
+    file_size = len(head)
+    with blob.open("wb", chunk_size=STREAM_CHUNK_SIZE, content_type=mime_type, if_generation_match=0) as writer:
+        writer.write(head)
+        for chunk in iter(lambda: stream.read(STREAM_CHUNK_SIZE), b""):
+            file_size += len(chunk)
+            if file_size > MAX_FILE_SIZE:
+                raise FileTooLargeError(f"Upload exceeds {MAX_FILE_SIZE_MB}MB")
+            digest.update(chunk)
+            writer.write(chunk)
+    return file_size, digest.hexdigest()
+
+def upload_blob_name(filename):
+    """
+    Unique object name for a streamed upload in the input bucket
+    """
+    return f"uploads/{uuid.uuid4().hex}/{secure_filename(filename or '') or 'document.pdf'}"
+
+def delete_uploaded_blobs(blobs):
+    """
+    Remove streamed inputs from GCS in one batched request - generation-matched so only the objects we wrote are deleted
+    """
+    if not blobs:
+        return
+    try:
+        with get_storage_client().batch():
+            for blob in blobs:
+                blob.delete(if_generation_match=blob.generation)
+    except NotFound:
+        pass
+    except Exception as e:
+        logger.warning("⚠️ Could not delete %d streamed upload(s) from gs://%s: %s", len(blobs), INPUT_BUCKET_NAME, e)
 
-def extract_with_document_ai(pdf_content):
+def process_uploaded_file(document_source, filename, file_size, digest, mime_type, page_count=None):
+    """
+    Extract a single uploaded document - runs on a worker thread.
+    page_count: PDF page count if the handler already probed it (skips a second parse)
+    """
+    # Estimate page count from file size
+    logger.debug("📊 %s: %d bytes, estimated pages: ~%d", filename, file_size, file_size // 50000)
+    
+    extracted_data = extract_with_document_ai(document_source, filename, mime_type, page_count)
+    
+    # ✅ Only cache real extractions - errors and page-limit fallbacks are retried next time
+    if not extracted_data.get("error_in_extraction") and "note" not in extracted_data:
+        put_cached(extraction_cache, digest, extracted_data)
+    
+    return dict(extracted_data, file_name=filename)
+
+def merge_extracted_data(documents):
+    """
+    Combine per-file extraction results into one payload for Gemini.
+    Texts stay per document (no combined copy) - Gemini receives one Part per document.
+    """
+    form_fields = {}
+    for data in documents:
+        form_fields.update(data.get("form_fields", {}))
+    
+    return {
+        "confidence": min(data.get("confidence", 0) for data in documents),
+        "page_count": sum(data.get("page_count", 0) for data in documents),
+        "entities": [entity for data in documents for entity in data.get("entities", [])],
+        "tables": [
+            dict(table, file_name=data.get("file_name"))
+            for data in documents for table in data.get("tables", [])
+        ],
+        "form_fields": form_fields,
+        "key_value_pairs": [pair for data in documents for pair in data.get("key_value_pairs", [])],
+        "documents": [
+            {
+                "file_name": data.get("file_name"),
+                "full_text": data.get("full_text", ""),
+                "page_count": data.get("page_count", 0),
+                "processing_method": data.get("processing_method", "error"),
+                "error": data.get("error")
+            }
+            for data in documents
+        ],
+        "processing_method": "multi_document_v3",
+        "processing_version": "3.0",
+        "processor_used": PROCESSOR_ID,
+        "error_in_extraction": any(data.get("error_in_extraction") for data in documents)
+    }
+
+def extract_with_document_ai(document_source, filename="document.pdf", mime_type="application/pdf", page_count=None):
     """
     ✅ SIMPLIFIED IMAGELESS MODE - VERSION 3.0 COMPLETE
+    Accepts raw file bytes or a gs:// URI for uploads streamed to GCS.
+    page_count: known PDF page count - only raw bytes without one are probed with pypdf
     """
     try:
-        print("🔧 INITIALIZING DOCUMENT AI CLIENT (VERSION 3.0)")
-        client = documentai.DocumentProcessorServiceClient()
-        name = f"projects/{PROJECT_ID}/locations/{PROCESSOR_LOCATION}/processors/{PROCESSOR_ID}"
-        print(f"🎯 Using processor path: {name}")
+        logger.debug("🎯 Using processor path: %s", PROCESSOR_NAME)
         
-        raw_document = documentai.RawDocument(
-            content=base64.b64decode(pdf_content),
-            mime_type="application/pdf"
-        )
-        print(f"📄 PDF decoded, size: {len(raw_document.content)} bytes")
+        # ✅ IMAGELESS MODE IS OPT-IN - without imageless_mode=True the online limit is 15 pages
+        logger.debug("⚙️ USING IMAGELESS MODE REQUEST (imageless_mode=True)")
+        if not isinstance(document_source, str) and mime_type == "application/pdf":
+            if page_count is None:
+                page_count = count_pdf_pages(io.BytesIO(document_source))
+            if page_count and MAX_ONLINE_PAGES < page_count <= MAX_ONLINE_PAGES * MAX_PDF_SHARDS:
+                # ✅ Over the online page limit - split into page-range shards instead of a doomed round trip
+                return extract_pdf_shards(document_source, filename, page_count)
+            if page_count and page_count > MAX_ONLINE_PAGES:
+                return extract_long_pdf(io.BytesIO(document_source), filename, f"{len(document_source) // 1000}KB", page_count)
         
-        # ✅ SIMPLIFIED IMAGELESS MODE REQUEST
-        print("⚙️ USING BASIC IMAGELESS MODE REQUEST (NO PROCESS_OPTIONS)")
-        request = documentai.ProcessRequest(
-            name=name,
-            raw_document=raw_document,
-            # ✅ NO PROCESS_OPTIONS = AUTOMATIC IMAGELESS MODE FOR LARGE DOCS
-        )
+        if isinstance(document_source, str):
+            # ✅ Document AI reads streamed uploads straight from GCS - no bytes in memory
+            logger.debug("📄 Processing document from GCS: %s", document_source)
+            request = documentai.ProcessRequest(
+                name=PROCESSOR_NAME,
+                gcs_document=documentai.GcsDocument(gcs_uri=document_source, mime_type=mime_type),
+                field_mask=DOCAI_FIELD_MASK,
+                imageless_mode=True,
+            )
+        else:
+            raw_document = documentai.RawDocument(
+                content=document_source,
+                mime_type=mime_type
+            )
+            logger.debug("📄 Document size: %d bytes (%s)", len(document_source), mime_type)
+            request = documentai.ProcessRequest(
+                name=PROCESSOR_NAME,
+                raw_document=raw_document,
+                field_mask=DOCAI_FIELD_MASK,
+                imageless_mode=True,
+            )
         
-        print("🚀 SENDING BASIC REQUEST TO DOCUMENT AI...")
-        result = client.process_document(request=request)
+        logger.debug("🚀 SENDING BASIC REQUEST TO DOCUMENT AI...")
+        with docai_semaphore:
+            result = get_docai_client().process_document(request=request, retry=DOCAI_RETRY)
         document = result.document
-        print(f"✅ SUCCESS - Pages processed: {len(document.pages)}")
+        # ✅ Bind once - every proto attribute access materializes a fresh Python object
+        text = document.text
+        pages = document.pages
+        logger.debug("✅ SUCCESS - Pages processed: %d", len(pages))
         
         # Extract comprehensive data
         extracted_data = {
-            "full_text": document.text,
+            "full_text": text,
             "confidence": 0.9,
-            "page_count": len(document.pages),
+            "page_count": len(pages),
             "entities": [],
             "tables": [],
             "form_fields": {},
@@ -155,20 +819,21 @@ def extract_with_document_ai(pdf_content):
             "processor_used": PROCESSOR_ID
         }
         
-        print(f"📊 EXTRACTING ENTITIES - Found: {len(document.entities)} entities")
+        entities = document.entities
+        logger.debug("📊 EXTRACTING ENTITIES - Found: %d entities", len(entities))
         # Extract entities
-        for entity in document.entities:
+        for entity in entities:
             extracted_data["entities"].append({
                 "type": entity.type_,
                 "mention_text": entity.mention_text,
                 "confidence": entity.confidence,
-                "normalized_value": getattr(entity, 'normalized_value', None)
+                "normalized_value": entity.normalized_value.text or None  # Proto message - keep its JSON-serializable text
             })
         
-        print(f"📋 EXTRACTING TABLES...")
+        logger.debug("📋 EXTRACTING TABLES AND FORM FIELDS...")
         table_count = 0
-        # Extract tables
-        for page_idx, page in enumerate(document.pages):
+        # Extract tables and form fields in one pass over the pages
+        for page_idx, page in enumerate(pages):
             for table_idx, table in enumerate(page.tables):
                 table_count += 1
                 table_data = {
@@ -180,45 +845,17 @@ def extract_with_document_ai(pdf_content):
                 
                 # Extract headers
                 for header_row in table.header_rows:
-                    header = []
-                    for cell in header_row.cells:
-                        cell_text = ""
-                        if cell.layout.text_anchor:
-                            start = cell.layout.text_anchor.text_segments[0].start_index
-                            end = cell.layout.text_anchor.text_segments[0].end_index
-                            cell_text = document.text[start:end].strip()
-                        header.append(cell_text)
-                    table_data["headers"] = header
+                    table_data["headers"] = [anchor_text(text, cell.layout.text_anchor) for cell in header_row.cells]
                 
                 # Extract body rows
                 for body_row in table.body_rows:
-                    row = []
-                    for cell in body_row.cells:
-                        cell_text = ""
-                        if cell.layout.text_anchor:
-                            start = cell.layout.text_anchor.text_segments[0].start_index
-                            end = cell.layout.text_anchor.text_segments[0].end_index
-                            cell_text = document.text[start:end].strip()
-                        row.append(cell_text)
-                    table_data["rows"].append(row)
+                    table_data["rows"].append([anchor_text(text, cell.layout.text_anchor) for cell in body_row.cells])
                 
                 extracted_data["tables"].append(table_data)
-        
-        # Extract form fields
-        for page in document.pages:
+            
             for form_field in page.form_fields:
-                field_name = ""
-                field_value = ""
-                
-                if form_field.field_name and form_field.field_name.text_anchor:
-                    start = form_field.field_name.text_anchor.text_segments[0].start_index
-                    end = form_field.field_name.text_anchor.text_segments[0].end_index
-                    field_name = document.text[start:end].strip()
-                
-                if form_field.field_value and form_field.field_value.text_anchor:
-                    start = form_field.field_value.text_anchor.text_segments[0].start_index
-                    end = form_field.field_value.text_anchor.text_segments[0].end_index
-                    field_value = document.text[start:end].strip()
+                field_name = anchor_text(text, form_field.field_name.text_anchor)
+                field_value = anchor_text(text, form_field.field_value.text_anchor)
                 
                 if field_name:
                     extracted_data["form_fields"][field_name] = field_value
@@ -228,31 +865,23 @@ def extract_with_document_ai(pdf_content):
                         "confidence": getattr(form_field, 'confidence', 0.8)
                     })
         
-        print(f"📋 TABLES EXTRACTED - Found: {table_count} tables")
-        print(f"🎉 DOCUMENT AI EXTRACTION COMPLETED SUCCESSFULLY!")
-        print(f"📊 FINAL STATS - Pages: {extracted_data['page_count']}, Entities: {len(extracted_data['entities'])}, Tables: {len(extracted_data['tables'])}")
+        logger.debug("📋 TABLES EXTRACTED - Found: %d tables", table_count)
+        logger.debug("🎉 DOCUMENT AI EXTRACTION COMPLETED SUCCESSFULLY!")
+        logger.info("📊 FINAL STATS - Pages: %d, Entities: %d, Tables: %d", extracted_data['page_count'], len(extracted_data['entities']), len(extracted_data['tables']))
         
         return extracted_data
         
     except Exception as e:
-        print(f"❌ DOCUMENT AI EXTRACTION ERROR (VERSION 3.0): {str(e)}")
-        print(f"❌ Error details: {type(e).__name__}")
+        logger.error("❌ DOCUMENT AI EXTRACTION ERROR (VERSION 3.0): %s: %s", type(e).__name__, e)
         
         # ✅ FALLBACK: Use simplified processing for large docs
         if "exceed the limit" in str(e) or "PAGE_LIMIT_EXCEEDED" in str(e):
-            print("🔄 TRYING FALLBACK PROCESSING FOR LARGE DOCUMENT...")
-            return {
-                "full_text": f"Large document ({len(base64.b64decode(pdf_content)) // 1000}KB) processed successfully with fallback method",
-                "confidence": 0.8,
-                "page_count": 23,  # Estimated from error
-                "entities": [],
-                "tables": [],
-                "form_fields": {},
-                "key_value_pairs": [],
-                "processing_method": "fallback_large_doc_v3",
-                "processing_version": "3.0",
-                "note": "Large document processed with fallback method due to page limit"
-            }
+            logger.warning("🔄 TRYING FALLBACK PROCESSING FOR LARGE DOCUMENT...")
+            if isinstance(document_source, str):
+                document_label = document_source
+            else:
+                document_label = f"{len(document_source) // 1000}KB"
+            return large_document_fallback(document_label)
         
         return {
             "error": f"Document AI failed: {str(e)}",
@@ -265,120 +894,264 @@ def extract_with_document_ai(pdf_content):
             "error_in_extraction": True
         }
 
-def analyze_with_gemini(extracted_data):
+def extract_pdf_shards(pdf_bytes, filename, page_count):
     """
-    ✅ CORRECTED GEMINI WITH PROPER MODELS FOR US-CENTRAL1 - VERSION 3.0
+    Split a long PDF into MAX_ONLINE_PAGES page ranges, extract them concurrently and stitch the results in page order
+    """
+    reader = PdfReader(io.BytesIO(pdf_bytes), strict=False)
+    shards = []
+    for first_page in range(0, page_count, MAX_ONLINE_PAGES):
+        writer = PdfWriter()
+        for page in reader.pages[first_page:first_page + MAX_ONLINE_PAGES]:
+            writer.add_page(page)
+        shard = io.BytesIO()
+        writer.write(shard)
+        shards.append((first_page, shard.getvalue()))
+    logger.info("✂️ %s: %d pages split into %d shards", filename, page_count, len(shards))
+    
+    with ThreadPoolExecutor(max_workers=min(MAX_EXTRACTION_WORKERS, len(shards))) as executor:
+        parts = list(executor.map(
+            lambda shard: extract_with_document_ai(shard[1], filename, page_count=min(MAX_ONLINE_PAGES, page_count - shard[0])),
+            shards
+        ))
+    
+    form_fields = {}
+    for part in parts:
+        form_fields.update(part.get("form_fields", {}))
+    
+    merged = {
+        "full_text": "\n".join(part.get("full_text", "") for part in parts),
+        "confidence": 0.9,
+        "page_count": page_count,
+        "entities": [entity for part in parts for entity in part.get("entities", [])],
+        "tables": [
+            dict(table, page=table["page"] + first_page)
+            for (first_page, _), part in zip(shards, parts) for table in part.get("tables", [])
+        ],
+        "form_fields": form_fields,
+        "key_value_pairs": [pair for part in parts for pair in part.get("key_value_pairs", [])],
+        "processing_method": "sharded_imageless_v3",
+        "processing_version": "3.0",
+        "processor_used": PROCESSOR_ID,
+        "error_in_extraction": any(part.get("error_in_extraction") for part in parts)
+    }
+    # ✅ A shard that still hit a page limit makes the whole result a fallback (never cached)
+    if any("note" in part for part in parts):
+        merged["note"] = "Some pages processed with fallback method due to page limit"
+    return merged
+
+def anchor_text(text, text_anchor):
+    """
+    Slice the document text covered by a layout's first text segment
+    """
+    if not text_anchor.text_segments:
+        return ""
+    segment = text_anchor.text_segments[0]
+    return text[segment.start_index:segment.end_index].strip()
+
+def count_pdf_pages(pdf_stream):
+    """
+    Page count read from the PDF page tree (no rendering) - None if the file can't be parsed
     """
     try:
-        print("🧠 INITIALIZING GEMINI (US-CENTRAL1 MODELS) - VERSION 3.0")
-        
-        # ✅ CORRECT MODEL PRIORITY FOR US-CENTRAL1
-        models_to_try = [
-             "gemini-1.5-flash-001",    # ✅ Specific version that works
-            "gemini-1.0-pro-001",      # ✅ Stable version  
-            "text-bison@001",          # ✅ Vertex AI Text model fallback
-]
-        
-        model = None
-        model_used = None
-        
-        for model_name in models_to_try:
-            try:
-                print(f"🔄 Trying model: {model_name} in us-central1")
-                model = GenerativeModel(model_name)
+        return len(PdfReader(pdf_stream, strict=False).pages)
+    except Exception as e:
+        logger.warning("⚠️ Could not read PDF page count: %s", e)
+        return None
+
+def extract_long_pdf(pdf_stream, filename, document_label, page_count):
+    """
+    PDFs too long to shard: digital ones still get their real text from the embedded text layer, scanned ones the placeholder
+    """
+    text_layer_data = extract_pdf_text_layer(pdf_stream, page_count)
+    if text_layer_data is not None:
+        return text_layer_data
+    logger.info("📏 %s has %d pages (> %d), using large document fallback", filename, page_count, MAX_ONLINE_PAGES * MAX_PDF_SHARDS)
+    return large_document_fallback(document_label, page_count)
+
+def extract_unshardable_pdf(pdf_stream, filename, file_size, digest, page_count):
+    """
+    extract_long_pdf on the request thread for an upload past the shard budget - cached like worker results
+    """
+    extracted_data = extract_long_pdf(pdf_stream, filename, f"{file_size // 1000}KB", page_count)
+    if "note" not in extracted_data:
+        put_cached(extraction_cache, digest, extracted_data)
+    return dict(extracted_data, file_name=filename)
+
+def extract_pdf_text_layer(pdf_stream, page_count):
+    """
+    Text from a digital PDF's embedded text layer - None if it looks scanned (sparse text or mostly undecodable glyphs)
+    """
+    try:
+        reader = PdfReader(pdf_stream, strict=False)
+        texts = [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        logger.warning("⚠️ Could not read PDF text layer: %s", e)
+        return None
+    
+    full_text = "\n".join(texts)
+    if len(full_text) < TEXT_LAYER_MIN_CHARS_PER_PAGE * page_count or full_text.count("\ufffd") * 100 > len(full_text):
+        return None
+    
+    logger.info("📝 Using embedded text layer for %d pages (%d chars)", page_count, len(full_text))
+    return {
+        "full_text": full_text,
+        "confidence": 0.85,
+        "page_count": page_count,
+        "entities": [],
+        "tables": [],
+        "form_fields": {},
+        "key_value_pairs": [],
+        "processing_method": "pdf_text_layer_v3",
+        "processing_version": "3.0",
+        "processor_used": "pypdf"
+    }
+
+def large_document_fallback(document_label, page_count=None):
+    """
+    Placeholder extraction for documents over the online page limit
+    """
+    return {
+        "full_text": f"Large document ({document_label}) processed successfully with fallback method",
+        "confidence": 0.8,
+        "page_count": page_count if page_count is not None else 23,  # Estimated from error
+        "entities": [],
+        "tables": [],
+        "form_fields": {},
+        "key_value_pairs": [],
+        "processing_method": "fallback_large_doc_v3",
+        "processing_version": "3.0",
+        "note": "Large document processed with fallback method due to page limit"
+    }
+
+def select_gemini_model():
+    """
+    Probe the model priority list and return (model_name, model) for the first one that responds.
+    The result is kept in gemini_model so warm invocations skip the probe until the TTL expires.
+    """
+    with gemini_model_lock:
+        if gemini_model is not None and time.monotonic() - gemini_model[2] < MODEL_PROBE_TTL_SECONDS:
+            return gemini_model[:2]
+        return probe_gemini_models()
+
+def probe_gemini_models():
+    """
+    Run the probe loop once and memoize the first working model - caller holds gemini_model_lock
+    """
+    global gemini_model
+    init_vertexai()
+    logger.info("🧠 INITIALIZING GEMINI (US-CENTRAL1 MODELS) - VERSION 3.0")
+    
+    for model_name in GEMINI_MODELS:
+        try:
+            logger.info("🔄 Trying model: %s in us-central1", model_name)
+            model = GenerativeModel(model_name)
+            
+            # ✅ CHECK THE MODEL IS SERVED - count_tokens is a metadata call, no billed generation
+            test_response = model.count_tokens("Test: return 'OK'")
+            if test_response.total_tokens:
+                logger.info("✅ SUCCESS: %s is working!", model_name)
+                gemini_model = (model_name, model, time.monotonic())
+                return model_name, model
                 
-                # ✅ TEST THE MODEL WITH A SIMPLE PROMPT
-                test_response = model.generate_content("Test: return 'OK'")
-                if test_response:
-                    model_used = model_name
-                    print(f"✅ SUCCESS: {model_name} is working!")
-                    break
-                    
-            except Exception as model_error:
-                print(f"❌ {model_name} failed: {str(model_error)}")
-                continue
-        
-        if not model:
-            raise Exception("All Gemini models failed in us-central1")
+        except Exception as model_error:
+            logger.warning("❌ %s failed: %s", model_name, model_error)
+            continue
+    
+    raise Exception("All Gemini models failed in us-central1")
+
+def text_excerpt(text, limit=PROMPT_TEXT_CHARS):
+    """
+    First `limit` chars of text, ending on a sentence (or at least word) boundary
+    """
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(". ", 0, limit)
+    if cut < limit // 2:
+        cut = text.rfind(" ", 0, limit)
+    return text[:cut + 1] if cut > 0 else text[:limit]
+
+def parse_json_response(response_text):
+    """
+    First JSON object in a model response - bare JSON, or wrapped in markdown/prose.
+    Raises ValueError (json.JSONDecodeError included) when nothing parses.
+    """
+    try:
+        return orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        # Models without JSON mode wrap it in markdown/prose - decode from the first brace
+        start = response_text.find("{")
+        if start == -1:
+            raise ValueError("No JSON structure found")
+        try:
+            return JSON_DECODER.raw_decode(response_text, start)[0]
+        except json.JSONDecodeError:
+            # One repair pass, then give up to the structured fallback
+            return JSON_DECODER.raw_decode(TRAILING_COMMA_RE.sub(r"\1", response_text[start:]))[0]
+
+def analyze_with_gemini(extracted_data, model_future=None):
+    """
+    ✅ CORRECTED GEMINI WITH PROPER MODELS FOR US-CENTRAL1 - VERSION 3.0
+    model_future: optional Future from select_gemini_model() started before extraction
+    """
+    try:
+        model_used, model = model_future.result() if model_future else select_gemini_model()
         
-        text_length = len(extracted_data.get('full_text', ''))
+        documents = extracted_data.get('documents', [extracted_data])
         page_count = extracted_data.get('page_count', 'unknown')
-        print(f"📊 Analyzing {page_count} pages, {text_length} chars with {model_used}")
+        if logger.isEnabledFor(logging.DEBUG):
+            text_length = sum(len(doc.get('full_text', '')) for doc in documents)
+            logger.debug("📊 Analyzing %s pages, %d chars with %s", page_count, text_length, model_used)
         
-        # ✅ OPTIMIZED PROMPT FOR AVAILABLE MODELS
-        prompt = f"""
-        Analyze this business document:
-
-        Pages: {page_count}
-        Text sample: {extracted_data.get('full_text', '')[:1200]}
+        # ✅ STATIC PREAMBLE FIRST, DOCUMENT DETAILS LAST
+        prompt = ANALYSIS_PROMPT_TEMPLATE.substitute(
+            page_count=page_count,
+            entity_count=len(extracted_data.get('entities', [])),
+            table_count=len(extracted_data.get('tables', []))
+        )
         
-        Entities found: {len(extracted_data.get('entities', []))}
-        Tables found: {len(extracted_data.get('tables', []))}
-
-        Provide analysis as JSON:
-        {{
-            "document_type": "financial report/contract/memo/etc",
-            "summary": "Brief executive summary in 2 sentences",
-            "key_insights": ["insight 1", "insight 2", "insight 3"],
-            "financial_metrics": {{"revenue": "amount", "profit": "amount"}},
-            "risk_factors": ["risk 1", "risk 2"],
-            "recommendations": ["action 1", "action 2"],
-            "confidence_level": "High"
-        }}
-
-        Return only valid JSON without markdown.
-        """
+        # ✅ One text sample Part per document instead of a joined copy of every text
+        contents = [prompt]
+        for doc in documents:
+            label = f"[{doc['file_name']}]" if 'file_name' in doc else "Text sample:"
+            contents.append(Part.from_text(f"{label}\n{text_excerpt(doc.get('full_text', ''))}"))
         
-        print(f"🤖 Sending analysis request to {model_used}...")
+        logger.debug("🤖 Sending analysis request to %s...", model_used)
         
-        # ✅ OPTIMIZED GENERATION CONFIG
-        generation_config = {
-            "temperature": 0.2,
-            "top_p": 0.9,
-            "top_k": 32,
-            "max_output_tokens": 1024,
-        }
+        # ✅ OPTIMIZED GENERATION CONFIG (JSON mode returns bare JSON - no fences to strip)
+        json_mode = model_used.startswith(JSON_MODE_MODEL_PREFIXES)
+        generation_config = GenerationConfig(
+            temperature=0.2,
+            top_p=0.9,
+            top_k=32,
+            max_output_tokens=1024,
+            response_mime_type="application/json" if json_mode else None,
+            response_schema=ANALYSIS_RESPONSE_SCHEMA if json_mode else None,
+        )
         
         response = model.generate_content(
-            prompt,
+            contents,
             generation_config=generation_config
         )
         
-        print(f"✅ {model_used} response received ({len(response.text)} chars)")
-        
         # ✅ ROBUST JSON PARSING
         try:
             response_text = response.text.strip()
+            logger.debug("✅ %s response received (%d chars)", model_used, len(response_text))
             
-            # Clean up the response
-            if "```json" in response_text:
-                start = response_text.find("```json") + 7
-                end = response_text.find("```", start)
-                json_text = response_text[start:end].strip()
-            elif "```" in response_text:
-                start = response_text.find("```") + 3
-                end = response_text.rfind("```")
-                json_text = response_text[start:end].strip()
-            elif "{" in response_text and "}" in response_text:
-                start = response_text.find("{")
-                end = response_text.rfind("}") + 1
-                json_text = response_text[start:end]
-            else:
-                raise ValueError("No JSON structure found")
-            
-            result = json.loads(json_text)
+            result = parse_json_response(response_text)
             
             # ✅ ADD PROCESSING INFO
             result["ai_model_used"] = model_used
             result["processing_region"] = "us-central1"
             result["processing_version"] = "3.0_complete"
             
-            print(f"✅ JSON parsed successfully with {model_used}")
+            logger.debug("✅ JSON parsed successfully with %s", model_used)
             return result
             
         except Exception as parse_error:
-            print(f"⚠️ JSON parsing failed with {model_used}: {parse_error}")
-            print(f"📄 Raw response: {response.text[:300]}...")
+            logger.warning("⚠️ JSON parsing failed with %s: %s", model_used, parse_error)
+            logger.warning("📄 Raw response: %.300s...", response.text)
             
             # ✅ STRUCTURED FALLBACK
             return {
@@ -404,15 +1177,14 @@ def analyze_with_gemini(extracted_data):
             }
         
     except Exception as e:
-        print(f"❌ GEMINI ANALYSIS ERROR (VERSION 3.0): {str(e)}")
-        models_attempted = ["gemini-1.5-flash", "gemini-pro", "gemini-1.0-pro", "gemini-1.5-pro"]
+        logger.error("❌ GEMINI ANALYSIS ERROR (VERSION 3.0): %s", e)
         return {
             "document_type": "Processing Error",
             "summary": f"Gemini analysis encountered an error: {str(e)}",
             "key_insights": [
                 "Document AI extraction completed successfully",
                 "Gemini analysis failed - manual review needed",
-                f"Attempted models: {', '.join(models_attempted)}"
+                f"Attempted models: {', '.join(GEMINI_MODELS)}"
             ],
             "financial_metrics": {},
             "risk_factors": ["AI analysis unavailable"],
@@ -427,13 +1199,8 @@ def analyze_with_gemini(extracted_data):
 @functions_framework.http  
 def health_check(request: Request):
     """Health check endpoint - VERSION 3.0"""
-    print("🏥 HEALTH CHECK - VERSION 3.0 COMPLETE")
-    headers = {
-        'Access-Control-Allow-Origin': 'http://localhost:8080',
-        'Content-Type': 'application/json'
-    }
-    
-    return (json.dumps({
+    logger.debug("🏥 HEALTH CHECK - VERSION 3.0 COMPLETE")
+    return (orjson.dumps({
         "status": "healthy", 
         "service": "AnalystIQ AI Functions",
         "processor_id": PROCESSOR_ID,
@@ -441,6 +1208,6 @@ def health_check(request: Request):
         "imageless_mode": "enabled",
         "max_pages": "auto-detected",
         "version": "3.0_complete_fixed",
-        "gemini_models": ["gemini-1.5-flash", "gemini-pro", "gemini-1.0-pro", "gemini-1.5-pro"],
-        "timestamp": datetime.now().isoformat()
-    }), 200, headers)
\ No newline at end of file
+        "gemini_models": GEMINI_MODELS,
+        "timestamp": datetime.now()
+    }), 200, RESPONSE_HEADERS)
\ No newline at end of file
@@ -0,0 +1,362 @@
+"""
+Tests for main.py - Document AI and Gemini are stubbed, no Google Cloud calls are made.
+Run from backend/functions: python -m pytest -q
+"""
+import io
+import json
+from collections import OrderedDict
+
+import pytest
+from flask import Request
+from pypdf import PdfReader, PdfWriter
+from werkzeug.test import EnvironBuilder
+
+import main
+
+
+def make_pdf(page_count):
+    writer = PdfWriter()
+    for _ in range(page_count):
+        writer.add_blank_page(width=72, height=72)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+PDF_BYTES = make_pdf(1)
+
+
+EXTRACTION_OK = {
+    "full_text": "Revenue grew 20% year over year.",
+    "confidence": 0.9,
+    "page_count": 1,
+    "entities": [],
+    "tables": [],
+    "form_fields": {},
+    "key_value_pairs": [],
+    "processing_method": "basic_imageless_v3",
+}
+EXTRACTION_FAILED = {
+    "error": "Document AI failed: 503 unavailable",
+    "full_text": "",
+    "entities": [],
+    "tables": [],
+    "form_fields": {},
+    "key_value_pairs": [],
+    "error_in_extraction": True,
+}
+EXTRACTION_PLACEHOLDER = dict(
+    EXTRACTION_OK,
+    full_text="Large document (900KB) processed successfully with fallback method",
+    processing_method="fallback_large_doc_v3",
+    note="Large document processed with fallback method due to page limit",
+)
+ANALYSIS_OK = {"document_type": "memo", "summary": "Growth memo.", "ai_model_used": "gemini-1.5-flash-001"}
+
+
+def make_request(chunked=False, **kwargs):
+    """
+    POST request built by EnvironBuilder; chunked drops Content-Length like a Transfer-Encoding: chunked body
+    """
+    environ = EnvironBuilder(method="POST", **kwargs).get_environ()
+    if chunked:
+        del environ["CONTENT_LENGTH"]
+        environ["wsgi.input_terminated"] = True
+    return Request(environ)
+
+
+def call(request):
+    """
+    (status code, decoded JSON body) returned by analyze_document
+    """
+    response = main.analyze_document(request)
+    return response[1], json.loads(response[0])
+
+
+@pytest.fixture
+def services(monkeypatch):
+    """
+    Canned Document AI / Gemini results - set services["extraction"] per test, services["calls"] counts extractions
+    """
+    state = {"extraction": EXTRACTION_OK, "calls": 0}
+
+    def extract(*args, **kwargs):
+        state["calls"] += 1
+        return dict(state["extraction"])
+
+    monkeypatch.setattr(main, "extract_with_document_ai", extract)
+    monkeypatch.setattr(main, "select_gemini_model", lambda: ("gemini-1.5-flash-001", None))
+    monkeypatch.setattr(main, "analyze_with_gemini", lambda *args, **kwargs: dict(ANALYSIS_OK))
+    main.extraction_cache.clear()
+    main.analysis_cache.clear()
+    yield state
+    main.extraction_cache.clear()
+    main.analysis_cache.clear()
+
+
+# --- merge_extracted_data ---
+
+def test_merge_extracted_data_combines_files():
+    merged = main.merge_extracted_data([
+        dict(EXTRACTION_OK, file_name="a.pdf", page_count=2, entities=[{"type": "org"}],
+             tables=[{"page": 1}], form_fields={"Company": "Acme"}, key_value_pairs=[{"key": "Company"}]),
+        dict(EXTRACTION_FAILED, file_name="b.pdf"),
+    ])
+
+    assert merged["page_count"] == 2
+    assert merged["confidence"] == 0
+    assert merged["entities"] == [{"type": "org"}]
+    assert merged["tables"] == [{"page": 1, "file_name": "a.pdf"}]
+    assert merged["form_fields"] == {"Company": "Acme"}
+    assert merged["key_value_pairs"] == [{"key": "Company"}]
+    assert merged["error_in_extraction"] is True
+    assert [(doc["file_name"], doc["full_text"], doc["error"]) for doc in merged["documents"]] == [
+        ("a.pdf", EXTRACTION_OK["full_text"], None),
+        ("b.pdf", "", EXTRACTION_FAILED["error"]),
+    ]
+
+
+# --- get_cached / put_cached ---
+
+def test_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(main, "CACHE_MAX_ENTRIES", 2)
+    cache = OrderedDict()
+    main.put_cached(cache, "a", 1)
+    main.put_cached(cache, "b", 2)
+    assert main.get_cached(cache, "a") == 1  # "a" is now most recently used
+    main.put_cached(cache, "c", 3)
+
+    assert main.get_cached(cache, "b") is None
+    assert main.get_cached(cache, "a") == 1
+    assert main.get_cached(cache, "c") == 3
+
+
+def test_cache_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache = OrderedDict()
+    main.put_cached(cache, "a", 1)
+
+    now[0] += main.CACHE_TTL_SECONDS
+    assert main.get_cached(cache, "a") == 1
+    now[0] += 1
+    assert main.get_cached(cache, "a") is None
+    assert "a" not in cache
+
+
+def test_duplicate_upload_reuses_cached_extraction_and_analysis(services):
+    for _ in range(2):
+        status, body = call(make_request(data={"file": (io.BytesIO(PDF_BYTES), "deck.pdf")}))
+        assert status == 200
+        assert body["ai_insights"]["summary"] == ANALYSIS_OK["summary"]
+
+    assert services["calls"] == 1
+    assert len(main.extraction_cache) == 1
+    assert len(main.analysis_cache) == 1
+
+
+@pytest.mark.parametrize("extraction", [EXTRACTION_FAILED, EXTRACTION_PLACEHOLDER])
+def test_failed_or_placeholder_extraction_is_not_cached(services, extraction):
+    services["extraction"] = extraction
+    for _ in range(2):
+        status, _ = call(make_request(data={"file": (io.BytesIO(PDF_BYTES), "deck.pdf")}))
+        assert status == 200
+
+    assert services["calls"] == 2
+    assert not main.extraction_cache
+    assert not main.analysis_cache
+
+
+# --- sniff_mime_type ---
+
+@pytest.mark.parametrize("head, mime_type", [
+    (b"%PDF-1.7\n", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n\x00\x00", "image/png"),
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF", "image/jpeg"),
+    (b"II*\x00\x08\x00", "image/tiff"),
+    (b"MM\x00*\x00\x08", "image/tiff"),
+    (b"GIF89a\x01\x00", "image/gif"),
+    (b"PK\x03\x04\x14\x00", None),
+    (b"%PD", None),
+    (b"", None),
+])
+def test_sniff_mime_type(head, mime_type):
+    assert main.sniff_mime_type(head) == mime_type
+
+
+def test_sniff_mime_type_accepts_whole_file():
+    assert main.sniff_mime_type(PDF_BYTES) == "application/pdf"
+
+
+# --- has_allowed_extension ---
+
+@pytest.mark.parametrize("filename, allowed", [
+    ("report.PDF", True),
+    ("scan.tiff", True),
+    ("archive.tar.png", True),
+    ("pdf", False),
+    ("report.exe", False),
+    ("", False),
+    (None, False),
+])
+def test_has_allowed_extension(filename, allowed):
+    assert main.has_allowed_extension(filename) is allowed
+
+
+# --- parse_json_response ---
+
+def test_parse_json_response_bare_json():
+    assert main.parse_json_response('{"summary": "ok"}') == {"summary": "ok"}
+
+
+def test_parse_json_response_markdown_fence_and_prose():
+    text = 'Here is the analysis:\n```json\n{"summary": "ok", "risk_factors": ["a"]}\n```\nThanks'
+    assert main.parse_json_response(text) == {"summary": "ok", "risk_factors": ["a"]}
+
+
+def test_parse_json_response_without_object_raises():
+    with pytest.raises(ValueError):
+        main.parse_json_response("No JSON here")
+
+
+def test_parse_json_response_unrepairable_raises():
+    with pytest.raises(json.JSONDecodeError):
+        main.parse_json_response('{"summary": "unterminated')
+
+
+def test_parse_json_response_repairs_trailing_commas():
+    text = '```json\n{"key_insights": ["a", "b",], "summary": "ok",}\n```'
+    assert main.parse_json_response(text) == {"key_insights": ["a", "b"], "summary": "ok"}
+
+
+# --- text_excerpt ---
+
+def test_text_excerpt_keeps_short_text():
+    assert main.text_excerpt("Short text.", limit=50) == "Short text."
+
+
+def test_text_excerpt_cuts_at_sentence_boundary():
+    text = "First sentence here. Second sentence is much longer than the limit allows"
+    assert main.text_excerpt(text, limit=36) == "First sentence here."
+
+
+def test_text_excerpt_ignores_early_sentence_boundary():
+    text = "First sentence here. Second sentence is much longer than the limit allows"
+    assert main.text_excerpt(text, limit=50) == "First sentence here. Second sentence is much "
+
+
+def test_text_excerpt_falls_back_to_word_boundary():
+    text = "Tiny. " + "word " * 20
+    excerpt = main.text_excerpt(text, limit=40)
+    assert len(excerpt) <= 40
+    assert excerpt.endswith("word ")
+
+
+def test_text_excerpt_hard_cuts_without_spaces():
+    assert main.text_excerpt("x" * 100, limit=10) == "x" * 10
+
+
+# --- extract_pdf_shards ---
+
+def fake_shard_extraction(results_by_shard_pages, calls):
+    """
+    Stand-in for extract_with_document_ai: identifies each shard by its page count and
+    returns one table on the shard's first page
+    """
+    def extract(shard_bytes, filename, page_count=None):
+        shard_pages = len(PdfReader(io.BytesIO(shard_bytes)).pages)
+        calls.append((shard_pages, page_count))
+        result = {
+            "full_text": f"shard of {shard_pages} pages",
+            "entities": [{"type": "org", "mention_text": filename}],
+            "tables": [{"page": 1, "table_id": 1, "headers": [], "rows": []}],
+            "form_fields": {},
+            "key_value_pairs": [],
+        }
+        result.update(results_by_shard_pages.get(shard_pages, {}))
+        return result
+    return extract
+
+
+def test_extract_pdf_shards_offsets_pages_and_passes_known_counts(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "extract_with_document_ai", fake_shard_extraction({}, calls))
+    shard_size = main.MAX_ONLINE_PAGES
+
+    merged = main.extract_pdf_shards(make_pdf(2 * shard_size + 5), "long.pdf", 2 * shard_size + 5)
+
+    assert sorted(calls) == [(5, 5), (shard_size, shard_size), (shard_size, shard_size)]
+    assert [table["page"] for table in merged["tables"]] == [1, shard_size + 1, 2 * shard_size + 1]
+    assert merged["page_count"] == 2 * shard_size + 5
+    assert merged["full_text"].split("\n") == [f"shard of {shard_size} pages"] * 2 + ["shard of 5 pages"]
+    assert len(merged["entities"]) == 3
+    assert merged["error_in_extraction"] is False
+    assert "note" not in merged
+
+
+def test_extract_pdf_shards_propagates_errors_and_notes(monkeypatch):
+    calls = []
+    overrides = {5: {"error_in_extraction": True, "tables": []}, main.MAX_ONLINE_PAGES: {"note": "page limit"}}
+    monkeypatch.setattr(main, "extract_with_document_ai", fake_shard_extraction(overrides, calls))
+
+    merged = main.extract_pdf_shards(make_pdf(main.MAX_ONLINE_PAGES + 5), "long.pdf", main.MAX_ONLINE_PAGES + 5)
+
+    assert merged["error_in_extraction"] is True
+    assert "note" in merged
+    assert [table["page"] for table in merged["tables"]] == [1]
+
+
+# --- rejected uploads ---
+
+@pytest.mark.parametrize("request_kwargs", [
+    {"data": {}},
+    {"data": {"file": (io.BytesIO(PDF_BYTES), "notes.txt")}},
+    {"data": {"file": (io.BytesIO(b"PK\x03\x04" + b"\x00" * 64), "deck.pdf")}},
+    {"json": [1, 2]},
+    {"json": {"file_name": "deck.pdf"}},
+    {"json": {"pdf_content": "not base64!", "file_name": "deck.pdf"}},
+    {"json": {"pdf_content": "JVBERi0", "file_name": "deck.pdf"}},  # Incorrect padding
+    {"json": {"pdf_content": 42, "file_name": "deck.pdf"}},
+])
+def test_invalid_upload_is_rejected_with_400(services, request_kwargs):
+    status, body = call(make_request(**request_kwargs))
+
+    assert status == 400
+    assert body["error_type"] == "InvalidUploadError"
+    assert services["calls"] == 0
+
+
+# --- size limits ---
+
+@pytest.fixture
+def small_limits(monkeypatch):
+    monkeypatch.setattr(main, "MAX_FILE_SIZE", 1024)
+    monkeypatch.setattr(main, "MAX_JSON_BODY_SIZE", 2048)
+    monkeypatch.setattr(main, "MAX_REQUEST_SIZE", 4096)
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_oversized_json_body_is_rejected_with_413(services, small_limits, chunked):
+    request = make_request(chunked=chunked, json={"pdf_content": "A" * 3000, "file_name": "deck.pdf"})
+    status, body = call(request)
+
+    assert status == 413
+    assert body["error_type"] == "FileTooLargeError"
+    assert services["calls"] == 0
+
+
+def test_oversized_chunked_raw_body_is_rejected_with_413(services, small_limits):
+    request = make_request(chunked=True, data=PDF_BYTES + b"\x00" * 2048, content_type="application/pdf",
+                           headers={"X-File-Name": "deck.pdf"})
+    status, body = call(request)
+
+    assert status == 413
+    assert services["calls"] == 0
+
+
+def test_oversized_chunked_multipart_body_is_rejected_with_413(services, small_limits):
+    request = make_request(chunked=True, data={"file": (io.BytesIO(PDF_BYTES + b"\x00" * 8192), "deck.pdf")})
+    status, body = call(request)
+
+    assert status == 413
+    assert services["calls"] == 0